@@ -1,13 +1,26 @@
 import asyncio
-import json
+import hashlib
+import logging
 import os
+import re
+import time
+from collections import deque
 from contextlib import asynccontextmanager
-from typing import Optional, List
+from datetime import datetime
+from typing import Callable, List, Optional, Union
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 
+# Serialize API responses with orjson when it is installed
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:
+    from fastapi.responses import JSONResponse as DefaultResponse
+
 # Load environment variables from .env early, before importing modules that read env
 try:
     from dotenv import load_dotenv
@@ -18,11 +31,13 @@ except Exception:
 
 try:
     # Try package-style imports (when run as module)
+    from .codec import JSON_BACKEND, encode_message, encode_msg, loads, message_prefix
     from .db import ensure_default_server, get_db, get_server_by_id, list_servers
     from .history_io import message_history
     from .models import ChatMessage, Server
 except ImportError:
     # Fall back to direct imports (when run directly or in tests)
+    from codec import JSON_BACKEND, encode_message, encode_msg, loads, message_prefix
     from db import ensure_default_server, get_db, get_server_by_id, list_servers
     from history_io import message_history
     from models import ChatMessage, Server
@@ -38,22 +53,36 @@ except ImportError as exc:
     ) from exc
 
 
+log = logging.getLogger("app")
+
+
+def _setup_logging() -> None:
+    """Give the app logger its own stderr handler.
+
+    uvicorn only configures its own loggers, so without this INFO records
+    from here would be dropped. Level comes from LOG_LEVEL (default INFO).
+    """
+    if log.handlers:
+        return
+    stderr = logging.StreamHandler()
+    stderr.setFormatter(logging.Formatter("%(asctime)s [%(name)s] %(levelname)s %(message)s"))
+    log.addHandler(stderr)
+    log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    # Handled here; don't repeat records through a configured root logger
+    log.propagate = False
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: ensure DB default server, warm NATS connection
-    with get_db() as conn:
-        ensure_default_server(conn)
+    _setup_logging()
+    await asyncio.to_thread(_ensure_default_server)
+    _load_index()
+    log.info("history JSON parser: %s", JSON_BACKEND)
     try:
-        await get_nats()
-        # Ensure JetStream and CHAT stream exist early to avoid races
-        try:
-            js = await get_jetstream()
-            try:
-                await js.stream_info("CHAT")
-            except Exception:
-                await js.add_stream(name="CHAT", subjects=["chat.*"])  # create if missing
-        except Exception:
-            pass
+        # Connect and ensure the CHAT stream exists once, up front, so handlers
+        # get the cached JetStream context without extra round-trips
+        await get_jetstream()
     except Exception:
         # It's okay if NATS isn't running at startup; connections will be
         # retried on first use
@@ -72,21 +101,75 @@ async def lifespan(app: FastAPI):
             await _nats_connection.close()
     except Exception:
         pass
+    try:
+        await message_history.close()
+    except Exception:
+        pass
 
 
-app = FastAPI(title="NATS Chatroom Prototype", lifespan=lifespan)
+app = FastAPI(
+    title="NATS Chatroom Prototype",
+    lifespan=lifespan,
+    default_response_class=DefaultResponse,
+)
+# Compress JSON history and static assets; GZipMiddleware only handles HTTP,
+# so websocket traffic is left to permessage-deflate.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 
 # Mount static files from project root ./public (one level up from package)
 public_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "public")
 if not os.path.isdir(public_dir):
     os.makedirs(public_dir, exist_ok=True)
-app.mount("/public", StaticFiles(directory=public_dir), name="public")
+
+# Asset names carrying a content hash (e.g. app.3f9a1c2b.js) never change
+_HASHED_ASSET = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers cache content-hashed assets forever."""
+
+    async def get_response(self, path: str, scope) -> Response:
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304) and _HASHED_ASSET.search(path):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+app.mount("/public", CachedStaticFiles(directory=public_dir), name="public")
+
+# index.html is read once and served from memory with an ETag
+_index: Optional[tuple[bytes, str]] = None
+
+
+def _load_index() -> Optional[tuple[bytes, str]]:
+    global _index
+    if _index is None:
+        index_path = os.path.join(public_dir, "index.html")
+        if not os.path.isfile(index_path):
+            return None
+        with open(index_path, "rb") as f:
+            body = f.read()
+        _index = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+    return _index
 
 
 _nats_connection: Optional[nats.NATS] = None
 _js: Optional["nats.js.JetStreamContext"] = None  # type: ignore[valid-type]
 
+# Max JetStream publishes per websocket awaiting their ack at the same time
+PUB_INFLIGHT = int(os.environ.get("CHAT_PUB_INFLIGHT", "64"))
+# Max frames buffered for a slow websocket; the oldest are dropped beyond it
+SEND_HWM = int(os.environ.get("CHAT_SEND_HWM", "1024"))
+
+# Latest frames kept per subscribed room to answer join history from memory
+HISTORY_CACHE = int(os.environ.get("CHAT_HISTORY_CACHE", "256"))
+# Seconds before a room re-reads Postgres for rows stored since its last seed
+HISTORY_CACHE_TTL = float(os.environ.get("CHAT_HISTORY_CACHE_TTL", "10"))
+
+# Frames dropped across all connections because a client fell behind
+dropped_frames = 0
+
 
 async def get_nats() -> nats.NATS:
     global _nats_connection
@@ -99,11 +182,175 @@ async def get_nats() -> nats.NATS:
     return _nats_connection
 
 
+class Room:
+    """One NATS subscription per chat room, fanned out to local websockets.
+
+    While subscribed, the room also keeps its latest frames in a ring buffer
+    so joining clients get their history without a Postgres query on every
+    join. Postgres lags the stream, so the stored part is re-read once it is
+    older than HISTORY_CACHE_TTL.
+    """
+
+    def __init__(self, server_id: int) -> None:
+        self.server_id = server_id
+        self.sub: Optional["nats.aio.subscription.Subscription"] = None
+        self.clients: set[Callable[[bytes], None]] = set()
+        # Frames seen live since subscribing, oldest first
+        self.recent: deque[bytes] = deque(maxlen=HISTORY_CACHE)
+        # Stored frames older than everything in recent, from the last seed
+        self._stored: list[bytes] = []
+        self._seeded_at: Optional[float] = None
+        self._seeding: Optional[asyncio.Task] = None
+
+    async def _on_message(self, msg) -> None:
+        self.recent.append(msg.data)
+        for deliver in self.clients:
+            deliver(msg.data)
+
+    def _stale(self) -> bool:
+        if len(self.recent) == HISTORY_CACHE:
+            # Live frames alone fill the buffer; stored rows would be cut off
+            return False
+        return self._seeded_at is None or time.monotonic() - self._seeded_at >= HISTORY_CACHE_TTL
+
+    async def _seed(self) -> None:
+        try:
+            rows = await message_history.get_recent_rows(self.server_id, HISTORY_CACHE)
+            if self.recent:
+                # Frames seen live may already be stored as well; keep the
+                # live copy, the one clients already have queued. The rest
+                # was published before subscribing, so it comes first.
+                live = {_frame_key(data) for data in self.recent}
+                rows = [row for row in rows if _frame_key(row) not in live]
+            self._stored = rows
+            self._seeded_at = time.monotonic()
+        finally:
+            self._seeding = None
+
+    async def history(self, limit: int, queued: Optional[deque[bytes]] = None) -> bytes:
+        """Return the latest ``limit`` frames as one JSON array.
+
+        ``queued`` is the joining client's live buffer: frames delivered to it
+        while the history was gathered are in the snapshot too, so they are
+        removed from it and the client sees each frame once.
+        """
+        if limit > HISTORY_CACHE:
+            frames = await message_history.get_recent_rows(self.server_id, limit)
+            if queued:
+                # Rows from Postgres are separate objects; compare contents
+                seen = {_frame_key(data) for data in frames}
+                _discard(queued, lambda data: _frame_key(data) in seen)
+        else:
+            if self._stale():
+                # Single-flight: clients joining at once share one query
+                if self._seeding is None:
+                    self._seeding = asyncio.create_task(self._seed())
+                await asyncio.shield(self._seeding)
+            frames = [*self._stored, *self.recent][-limit:] if limit > 0 else []
+            if queued:
+                # Live frames are the very objects the room appended
+                seen_ids = {id(data) for data in frames}
+                _discard(queued, lambda data: id(data) in seen_ids)
+        return b"[" + b",".join(frames) + b"]"
+
+
+def _frame_key(data: bytes) -> tuple:
+    # Postgres renders stored frames with different spacing and timestamp
+    # precision, so frames are compared by their fields
+    try:
+        msg = loads(data)
+        return (
+            msg["type"],
+            msg["username"],
+            msg["text"],
+            msg["event"],
+            datetime.fromisoformat(msg["timestamp"]),
+        )
+    except (KeyError, TypeError, ValueError):
+        return (data,)
+
+
+def _discard(buf: deque[bytes], drop: Callable[[bytes], bool]) -> None:
+    kept = [data for data in buf if not drop(data)]
+    buf.clear()
+    buf.extend(kept)
+
+
+_rooms: dict[int, Room] = {}
+_rooms_lock = asyncio.Lock()
+
+
+async def join_room(nc: nats.NATS, server_id: int, deliver: Callable[[bytes], None]) -> Room:
+    async with _rooms_lock:
+        room = _rooms.get(server_id)
+        if room is None:
+            room = Room(server_id)
+            room.sub = await nc.subscribe(f"chat.{server_id}", cb=room._on_message)
+            _rooms[server_id] = room
+        room.clients.add(deliver)
+        return room
+
+
+async def leave_room(server_id: int, deliver: Callable[[bytes], None]) -> None:
+    async with _rooms_lock:
+        room = _rooms.get(server_id)
+        if room is None:
+            return
+        room.clients.discard(deliver)
+        if not room.clients:
+            # Last local client gone: drop the shared subscription; without
+            # it the ring buffer would go stale, so it is dropped too
+            del _rooms[server_id]
+            await room.sub.unsubscribe()
+
+
+# Servers rarely change; found rows are cached so handshakes skip SQLite
+SERVER_CACHE_TTL = 30.0
+_server_cache: dict[int, tuple[float, dict]] = {}
+_server_lookups: dict[int, asyncio.Task] = {}
+
+
+# SQLite calls block, so handlers run them in a worker thread via these helpers
+def _ensure_default_server() -> None:
+    with get_db() as conn:
+        ensure_default_server(conn)
+
+
+def _list_servers() -> list[dict]:
+    with get_db() as conn:
+        return list_servers(conn)
+
+
+def _lookup_server(server_id: int) -> Optional[dict]:
+    with get_db() as conn:
+        return get_server_by_id(conn, server_id)
+
+
+def _store_lookup(server_id: int, task: asyncio.Task) -> None:
+    _server_lookups.pop(server_id, None)
+    if not task.cancelled() and task.exception() is None and task.result() is not None:
+        _server_cache[server_id] = (time.monotonic(), task.result())
+
+
+async def cached_server(server_id: int) -> Optional[dict]:
+    hit = _server_cache.get(server_id)
+    if hit is not None and time.monotonic() - hit[0] < SERVER_CACHE_TTL:
+        return hit[1]
+    # Single-flight: concurrent misses for the same id share one query, which
+    # runs in a worker thread so the event loop is not blocked.
+    task = _server_lookups.get(server_id)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(_lookup_server, server_id))
+        _server_lookups[server_id] = task
+        task.add_done_callback(lambda t: _store_lookup(server_id, t))
+    return await asyncio.shield(task)
+
+
 async def get_jetstream():
     global _js
-    nc = await get_nats()
     if _js is not None:
         return _js
+    nc = await get_nats()
     js = nc.jetstream()
     # Ensure stream exists for chat subjects
     try:
@@ -118,42 +365,54 @@ async def get_jetstream():
 
 
 @app.get("/", response_class=HTMLResponse)
-async def root_html() -> HTMLResponse:
+async def root_html(request: Request) -> Response:
     # Serve the index.html from /public
-    index_path = os.path.join(public_dir, "index.html")
-    if not os.path.isfile(index_path):
+    index = _load_index()
+    if index is None:
         raise HTTPException(status_code=404, detail="index.html not found")
-    with open(index_path, "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    body, etag = index
+    # no-cache: browsers keep the page but revalidate it via If-None-Match
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=body, headers=headers)
 
 
 @app.get("/api/servers", response_model=List[Server])
 async def api_list_servers() -> list[Server]:
-    with get_db() as conn:
-        servers = list_servers(conn)
-    return [Server(**srv) for srv in servers]
+    # response_model validates the dicts; no need to build models here too
+    return await asyncio.to_thread(_list_servers)
 
 
 @app.get("/api/servers/{server_id}/messages", response_model=List[ChatMessage])
-async def api_get_messages(server_id: int, limit: int = 100) -> list[ChatMessage]:
-    """Get message history for a server."""
-    with get_db() as conn:
-        server = get_server_by_id(conn, server_id)
-        if server is None:
-            raise HTTPException(status_code=404, detail="Server not found")
+async def api_get_messages(
+    server_id: int, limit: int = 100, validate: bool = False
+) -> Union[Response, List[ChatMessage]]:
+    """Get message history for a server.
+
+    Pass ``validate=1`` to round-trip the messages through ChatMessage.
+    """
+    if await cached_server(server_id) is None:
+        raise HTTPException(status_code=404, detail="Server not found")
+
+    if validate:
+        return await message_history.get_messages(server_id, limit)
+    # Postgres renders history rows as JSON; pass them through undecoded
+    body = await message_history.get_messages_json(server_id, limit)
+    return Response(content=body, media_type="application/json")
 
-    messages = await message_history.get_messages(server_id, limit)
-    # Coerce to models (accept dicts from storage)
-    return [ChatMessage(**m) if not isinstance(m, ChatMessage) else m for m in messages]
+
+@app.get("/api/stats")
+async def api_stats() -> dict:
+    """Counters for this process since it started."""
+    return {"rooms": len(_rooms), "dropped_frames": dropped_frames}
 
 
 @app.websocket("/ws/{server_id}")
 async def websocket_endpoint(websocket: WebSocket, server_id: int) -> None:
-    with get_db() as conn:
-        server = get_server_by_id(conn, server_id)
-        if server is None:
-            await websocket.close(code=1008)
-            return
+    if await cached_server(server_id) is None:
+        await websocket.close(code=1008)
+        return
 
     # Require username in query params
     username = websocket.query_params.get("username")
@@ -174,91 +433,178 @@ async def websocket_endpoint(websocket: WebSocket, server_id: int) -> None:
             await websocket.close(code=1013)  # Try Again Later
         finally:
             return
+    # Subjects stay str: nats-py formats them into the PUB line with an
+    # f-string, so bytes would be sent as "b'...'"
     subject = f"chat.{server_id}"
-
-    send_queue: asyncio.Queue[bytes] = asyncio.Queue()
-
-    async def nats_message_handler(msg):
+    watch_subject = f"chat.history.watch.{server_id}"
+    # serverId and username are fixed for the connection; encode them once
+    prefix = message_prefix(server_id, username)
+
+    # Single producer (NATS callback), single consumer (ws_sender): a deque
+    # plus a wake-up future is cheaper than asyncio.Queue for this shape.
+    loop = asyncio.get_running_loop()
+    send_buf: deque[bytes] = deque(maxlen=SEND_HWM)
+    waker: Optional[asyncio.Future] = None
+    dropped = 0
+
+    def deliver(data: bytes) -> None:
+        global dropped_frames
+        nonlocal dropped
         # Only forward to WebSocket; message persistence is handled by the
         # dedicated message history microservice.
-        await send_queue.put(msg.data)
+        if len(send_buf) == SEND_HWM:
+            # Slow client: the bounded deque drops its oldest frame
+            dropped += 1
+            dropped_frames += 1
+        send_buf.append(data)
+        if waker is not None and not waker.done():
+            waker.set_result(None)
 
-    sub = await nc.subscribe(subject, cb=nats_message_handler)
+    room = await join_room(nc, server_id, deliver)
 
     async def ws_sender():
+        nonlocal waker
+        # NATS payloads are already UTF-8 JSON; forward them as binary frames
+        # through the raw ASGI send instead of decoding for send_text.
+        send = websocket.send
         try:
             while True:
-                data = await send_queue.get()
-                await websocket.send_text(data.decode("utf-8"))
+                if not send_buf:
+                    waker = loop.create_future()
+                    await waker
+                    waker = None
+                while send_buf:
+                    await send({"type": "websocket.send", "bytes": send_buf.popleft()})
         except Exception:
             pass
 
-    sender_task = asyncio.create_task(ws_sender())
+    # Started once history has been sent, so it is the first frame the client sees
+    sender_task: Optional[asyncio.Task] = None
 
-    try:
-        # Send message history to the new user (best-effort)
+    async def fetch_history() -> Optional[bytes]:
         try:
-            history_messages = await message_history.get_messages(server_id, limit=50)
+            return await room.history(50, send_buf)
         except Exception:
-            history_messages = []
-        for msg in history_messages:
-            try:
-                if isinstance(msg, ChatMessage):
-                    await websocket.send_text(msg.model_dump_json(by_alias=True))
-                else:
-                    await websocket.send_text(json.dumps(msg))
-            except Exception:
-                # If we can't send history, continue anyway
-                pass
+            return None
 
+    async def notify_watch() -> None:
         # Notify history service to watch this room
         try:
-            await nc.publish(f"chat.history.watch.{server_id}", b"{}")
+            await nc.publish(watch_subject, b"{}")
         except Exception:
             pass
 
-        # Notify join
-        join_msg = ChatMessage(type="system", event="join", server_id=server_id, username=username)
-        await js.publish(subject, join_msg.model_dump_json(by_alias=True).encode("utf-8"))
+    # Bounded so a client outrunning JetStream is throttled at the socket
+    pub_queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=SEND_HWM)
+    inflight = asyncio.Semaphore(PUB_INFLIGHT)
+    publishing: set[asyncio.Task] = set()
+    # First failed publish; the receive loop then closes the socket
+    publish_error: Optional[Exception] = None
+
+    async def publish_one(payload: bytes) -> None:
+        nonlocal publish_error
+        try:
+            await js.publish(subject, payload)
+        except Exception as exc:
+            log.warning("publish failed server=%d user=%s: %s", server_id, username, exc)
+            if publish_error is None:
+                publish_error = exc
+        finally:
+            inflight.release()
+            pub_queue.task_done()
+
+    async def publisher():
+        # Sliding window of unacked JetStream publishes: a new frame goes out
+        # as soon as any ack frees a slot, rather than one round-trip each.
+        while True:
+            payload = await pub_queue.get()
+            await inflight.acquire()
+            task = asyncio.create_task(publish_one(payload))
+            publishing.add(task)
+            task.add_done_callback(publishing.discard)
+
+    publisher_task = asyncio.create_task(publisher())
+
+    try:
+        # Run the history query concurrently with the watch and join publishes
+        history_task = asyncio.create_task(fetch_history())
+        await asyncio.gather(
+            notify_watch(),
+            js.publish(subject, encode_msg("system", server_id, username, event="join")),
+        )
+
+        # Send message history to the new user as one JSON array frame (best-effort)
+        history = await history_task
+        if history is not None:
+            try:
+                await websocket.send_bytes(history)
+            except Exception:
+                # If we can't send history, continue anyway
+                pass
+        sender_task = asyncio.create_task(ws_sender())
 
         while True:
             text = await websocket.receive_text()
-            # Expect client to send simple text; wrap into model
-            chat_msg = ChatMessage(
-                type="message",
-                server_id=server_id,
-                text=text,
-                username=username,
-            )
-            await js.publish(subject, chat_msg.model_dump_json(by_alias=True).encode("utf-8"))
+            if publish_error is not None:
+                # A message was lost; close so the client reconnects instead
+                # of typing into a publisher that is failing
+                await websocket.close(code=1013)  # Try Again Later
+                break
+            await pub_queue.put(encode_message(prefix, text))
 
     except WebSocketDisconnect:
         pass
     finally:
+        # Let queued messages go out before the leave notice
         try:
-            # Notify leave
-            leave_msg = ChatMessage(
-                type="system",
-                event="leave",
-                server_id=server_id,
-                username=username,
-            )
-            js = await get_jetstream()
-            await js.publish(subject, leave_msg.model_dump_json(by_alias=True).encode("utf-8"))
+            await asyncio.wait_for(pub_queue.join(), timeout=1)
         except Exception:
             pass
+        publisher_task.cancel()
 
         try:
-            await nc.flush(timeout=1)
+            # Notify leave, reusing the JetStream context from the handshake
+            await js.publish(subject, encode_msg("system", server_id, username, event="leave"))
         except Exception:
             pass
 
         try:
-            await sub.unsubscribe()
+            await nc.flush(timeout=1)
         except Exception:
             pass
 
         try:
-            sender_task.cancel()
+            await leave_room(server_id, deliver)
         except Exception:
             pass
+
+        if sender_task is not None:
+            sender_task.cancel()
+
+        if dropped:
+            log.warning(
+                "dropped %d frames for slow client server=%d user=%s (total %d)",
+                dropped,
+                server_id,
+                username,
+                dropped_frames,
+            )
+
+
+def main() -> None:
+    import uvicorn
+
+    # uvloop/httptools ship with uvicorn[standard] and cut per-await and
+    # per-frame overhead compared to the asyncio selector loop and h11
+    uvicorn.run(
+        app,
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+    )
+
+
+if __name__ == "__main__":
+    main()
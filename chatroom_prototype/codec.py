@@ -0,0 +1,137 @@
+import json
+import time
+from datetime import datetime, timezone
+from typing import Any, Iterable, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    # Optional: pysimdjson (fastest with AVX2) for parsing batches of documents
+    import simdjson
+except ImportError:
+    simdjson = None  # type: ignore[assignment]
+
+
+if orjson is not None:
+    dumps = orjson.dumps
+    loads = orjson.loads
+else:
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    loads = json.loads
+
+
+def _simdjson_parser() -> Optional["simdjson.Parser"]:
+    """Return a parser if simdjson has a SIMD kernel for this CPU.
+
+    pysimdjson picks its kernel at runtime; on hosts where it only has the
+    generic fallback, orjson/json is faster, so simdjson is not used.
+    """
+    if simdjson is None:
+        return None
+    try:
+        parser = simdjson.Parser()
+        parser.parse(b"{}")
+        if parser.implementation[0] == "fallback":
+            return None
+    except Exception:
+        return None
+    return parser
+
+
+_parser = _simdjson_parser()
+
+# Which backend loads_many uses on this host, for startup logging
+if _parser is not None:
+    JSON_BACKEND = f"simdjson ({_parser.implementation[1]})"
+elif orjson is not None:
+    JSON_BACKEND = "orjson"
+else:
+    JSON_BACKEND = "json"
+
+
+if _parser is not None:
+
+    def loads_many(docs: Iterable[bytes]) -> list:
+        """Parse a batch of JSON documents with one reused simdjson parser."""
+        out = []
+        for doc in docs:
+            value = _parser.parse(doc)
+            # Proxies are invalidated by the next parse; materialize each one
+            if isinstance(value, simdjson.Object):
+                value = value.as_dict()
+            elif isinstance(value, simdjson.Array):
+                value = value.as_list()
+            out.append(value)
+        return out
+
+else:
+
+    def loads_many(docs: Iterable[bytes]) -> list:
+        """Parse a batch of JSON documents."""
+        return [loads(doc) for doc in docs]
+
+
+def message_prefix(server_id: int, username: str) -> bytes:
+    """Build the constant head of a chat frame for one connection.
+
+    The result is an unterminated JSON object ending in ``"text":`` so that
+    only the text and timestamp have to be encoded per message.
+    """
+    head = dumps({"type": "message", "serverId": server_id, "username": username})
+    return head[:-1] + b',"text":'
+
+
+def encode_message(prefix: bytes, text: Optional[str]) -> bytes:
+    # Mirror ChatMessage._trim_text: strip and map empty text to null
+    if text is not None:
+        text = text.strip() or None
+    return prefix + dumps(text) + b',"event":null,"timestamp":' + _timestamp() + b"}"
+
+
+def encode_msg(
+    type_: str,
+    server_id: int,
+    username: Optional[str],
+    text: Optional[str] = None,
+    event: Optional[str] = None,
+) -> bytes:
+    """Encode a one-off frame (e.g. join/leave) in the ChatMessage wire format.
+
+    Use message_prefix/encode_message for the repeated per-connection path.
+    """
+    head = dumps(
+        {
+            "type": type_,
+            "serverId": server_id,
+            "username": username,
+            "text": text,
+            "event": event,
+        }
+    )
+    return head[:-1] + b',"timestamp":' + _timestamp() + b"}"
+
+
+# Second the cached timestamp head was formatted for, and the head itself
+_ts_second = -1
+_ts_head = b""
+
+
+def _timestamp() -> bytes:
+    """Return the current UTC time as a quoted ISO-8601 JSON string.
+
+    The date and time of day are formatted once per second; each call only
+    fills in the microseconds.
+    """
+    global _ts_second, _ts_head
+    second, micros = divmod(time.time_ns() // 1000, 1_000_000)
+    if second != _ts_second:
+        now = datetime.fromtimestamp(second, timezone.utc)
+        _ts_head = now.strftime('"%Y-%m-%dT%H:%M:%S.').encode()
+        _ts_second = second
+    return b'%s%06d+00:00"' % (_ts_head, micros)
@@ -1,5 +1,6 @@
 import os
 import sqlite3
+import threading
 from contextlib import contextmanager
 from typing import Iterator, Optional
 
@@ -19,15 +20,38 @@ def _init_schema(conn: sqlite3.Connection) -> None:
     conn.commit()
 
 
+# One connection per thread (handlers call in from asyncio.to_thread workers),
+# reopened if DB_PATH changes. Keeping it open also keeps sqlite3's
+# per-connection statement cache warm.
+_local = threading.local()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    # Rows stay plain tuples; building sqlite3.Row objects only to copy them
+    # into dicts is wasted work
+    conn = sqlite3.connect(path)
+    # WAL lets readers run alongside a writer and commits without a full fsync
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    _init_schema(conn)
+    return conn
+
+
 @contextmanager
 def get_db() -> Iterator[sqlite3.Connection]:
-    conn = sqlite3.connect(DB_PATH)
+    cached = getattr(_local, "conn", None)
+    if cached is None or cached[0] != DB_PATH:
+        if cached is not None:
+            cached[1].close()
+        cached = _local.conn = (DB_PATH, _connect(DB_PATH))
+    conn = cached[1]
     try:
-        conn.row_factory = sqlite3.Row
-        _init_schema(conn)
         yield conn
-    finally:
-        conn.close()
+    except BaseException:
+        # Don't leave a half-done transaction on the shared connection
+        conn.rollback()
+        raise
 
 
 def ensure_default_server(conn: sqlite3.Connection) -> None:
@@ -47,7 +71,7 @@ def ensure_default_server(conn: sqlite3.Connection) -> None:
 
 def list_servers(conn: sqlite3.Connection) -> list[dict]:
     cur = conn.execute("SELECT id, name FROM servers ORDER BY id ASC")
-    return [{"id": row["id"], "name": row["name"]} for row in cur.fetchall()]
+    return [{"id": server_id, "name": name} for server_id, name in cur]
 
 
 def get_server_by_id(conn: sqlite3.Connection, server_id: int) -> Optional[dict]:
@@ -58,4 +82,4 @@ def get_server_by_id(conn: sqlite3.Connection, server_id: int) -> Optional[dict]
     row = cur.fetchone()
     if row is None:
         return None
-    return {"id": row["id"], "name": row["name"]}
+    return {"id": row[0], "name": row[1]}
@@ -1,12 +1,54 @@
 import os
-import json
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 import asyncpg
 from datetime import datetime, timezone
 
 
+from .codec import dumps, loads_many
 from .models import ChatMessage
 
+# Messages are rebuilt in wire format from the typed columns; json_build_object
+# keeps keys in the same order as the live frames. The newest $2 rows are read
+# backwards along the (server_id, timestamp) index, then returned oldest first.
+# The server id key is $3: live frames use serverId, while the REST API has
+# always returned ChatMessage dumped by alias, i.e. server_id.
+_SELECT_MESSAGES = """
+    SELECT message FROM (
+        SELECT json_build_object(
+            'type', type,
+            $3::text, server_id,
+            'username', username,
+            'text', text,
+            'event', event,
+            'timestamp', timestamp
+        ) AS message, timestamp
+        FROM messages
+        WHERE server_id = $1
+        ORDER BY timestamp DESC
+        LIMIT $2
+    ) AS latest
+    ORDER BY timestamp ASC
+"""
+
+_COLUMNS = ["server_id", "type", "event", "username", "text", "timestamp"]
+
+_INSERT_MESSAGE = """
+    INSERT INTO messages (server_id, type, event, username, text, timestamp)
+    VALUES ($1, $2, $3, $4, $5, $6)
+"""
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    # Hand json values over as raw UTF-8 bytes (the binary format of json is
+    # its text), so rows can be forwarded without a decode/encode round-trip
+    await conn.set_type_codec(
+        "json",
+        encoder=lambda v: v if isinstance(v, bytes) else dumps(v),
+        decoder=bytes,
+        schema="pg_catalog",
+        format="binary",
+    )
+
 
 class MessageHistory:
     """Handles saving and retrieving message history from Postgres."""
@@ -25,7 +67,17 @@ class MessageHistory:
             return
         if not self.database_url:
             raise ValueError("DATABASE_URL must be set for Postgres connection")
-        self.pool = await asyncpg.create_pool(dsn=self.database_url)
+        # create_pool opens min_size connections up front, so the pool is warm
+        # before the first query; idle extras are closed after 5 minutes.
+        # Web replicas rarely query, so keep the default floor small.
+        max_size = int(os.environ.get("POOL_MAX", "25"))
+        self.pool = await asyncpg.create_pool(
+            dsn=self.database_url,
+            min_size=min(int(os.environ.get("POOL_MIN", "2")), max_size),
+            max_size=max_size,
+            max_inactive_connection_lifetime=300,
+            init=_init_connection,
+        )
         # Ensure required schema exists
         await self._ensure_schema()
 
@@ -46,15 +98,15 @@ class MessageHistory:
                     event TEXT,
                     username TEXT,
                     text TEXT,
-                    timestamp TIMESTAMPTZ,
-                    raw_data JSONB
+                    timestamp TIMESTAMPTZ
                 );
                 CREATE INDEX IF NOT EXISTS idx_messages_server_id_timestamp
                     ON messages(server_id, timestamp);
                 """
             )
 
-    async def save_message(self, server_id: int, message_data: Union[Dict, ChatMessage]) -> None:
+    @staticmethod
+    def _to_row(server_id: int, message_data: Union[Dict, ChatMessage]) -> tuple:
         # Normalize timestamp to a datetime object for timestamptz column
         if isinstance(message_data, ChatMessage):
             data_dict = message_data.model_dump(by_alias=True)
@@ -72,38 +124,86 @@ class MessageHistory:
             ts_dt = ts
         else:
             ts_dt = datetime.now(timezone.utc)
+        return (
+            server_id,
+            data_dict.get("type"),
+            data_dict.get("event"),
+            data_dict.get("username"),
+            data_dict.get("text"),
+            ts_dt,
+        )
 
+    async def save_message(self, server_id: int, message_data: Union[Dict, ChatMessage]) -> None:
         await self._ensure_pool()
         async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO messages (server_id, type, event, username, text, timestamp, raw_data)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                """,
-                server_id,
-                data_dict.get("type"),
-                data_dict.get("event"),
-                data_dict.get("username"),
-                data_dict.get("text"),
-                ts_dt,
-                json.dumps(data_dict),
-            )
+            await conn.execute(_INSERT_MESSAGE, *self._to_row(server_id, message_data))
 
-    async def get_messages(self, server_id: int, limit: Optional[int] = 100) -> List[ChatMessage]:
+    async def save_messages_bulk(
+        self, messages: Iterable[Tuple[int, Union[Dict, ChatMessage]]]
+    ) -> None:
+        """Write ``(server_id, message)`` pairs with a single COPY."""
+        rows = [self._to_row(server_id, data) for server_id, data in messages]
+        if not rows:
+            return
         await self._ensure_pool()
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                """
-                SELECT raw_data
-                FROM messages
-                WHERE server_id = $1
-                ORDER BY timestamp ASC
-                LIMIT $2
-                """,
-                server_id,
-                limit,
-            )
-        return [ChatMessage(**json.loads(row["raw_data"])) for row in rows]
+            await conn.copy_records_to_table("messages", records=rows, columns=_COLUMNS)
+
+    async def save_messages_each(
+        self, messages: Iterable[Tuple[int, Union[Dict, ChatMessage]]]
+    ) -> List[bool]:
+        """Insert ``(server_id, message)`` pairs one row at a time.
+
+        For when a bulk COPY failed: one bad row cannot hold back the rest.
+        Returns whether each pair was stored; False means Postgres rejected
+        the row's data. Any other error (e.g. a lost connection) is raised.
+        """
+        await self._ensure_pool()
+        stored = []
+        async with self.pool.acquire() as conn:
+            for server_id, data in messages:
+                try:
+                    await conn.execute(_INSERT_MESSAGE, *self._to_row(server_id, data))
+                except asyncpg.DataError:
+                    stored.append(False)
+                else:
+                    stored.append(True)
+        return stored
+
+    async def close(self) -> None:
+        """Close the pool's connections."""
+        if self.pool is None:
+            return
+        pool, self.pool = self.pool, None
+        await pool.close()
+
+    async def get_recent_rows(
+        self, server_id: int, limit: Optional[int], server_key: str = "serverId"
+    ) -> List[bytes]:
+        """Return the latest ``limit`` messages, oldest first, as JSON objects.
+
+        ``server_key`` names the server id field; the default matches live frames.
+        """
+        await self._ensure_pool()
+        async with self.pool.acquire() as conn:
+            # Same SQL text every call, so asyncpg's per-connection statement
+            # cache reuses the server-side prepared plan.
+            rows = await conn.fetch(_SELECT_MESSAGES, server_id, limit, server_key)
+        return [row["message"] for row in rows]
+
+    async def get_messages(self, server_id: int, limit: Optional[int] = 100) -> List[ChatMessage]:
+        rows = await self.get_recent_rows(server_id, limit)
+        return [ChatMessage(**m) for m in loads_many(rows)]
+
+    async def get_messages_json(self, server_id: int, limit: Optional[int] = 100) -> bytes:
+        """Return messages as an encoded JSON array, skipping model round-trips.
+
+        Postgres already renders each row as a JSON object, so rows are
+        spliced together without being decoded. The objects match
+        ``ChatMessage`` dumped by alias, as the REST API returns them.
+        """
+        rows = await self.get_recent_rows(server_id, limit, server_key="server_id")
+        return b"[" + b",".join(rows) + b"]"
 
     async def clear_history(self, server_id: int) -> None:
         await self._ensure_pool()
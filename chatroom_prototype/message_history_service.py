@@ -1,8 +1,10 @@
 import asyncio
-import json
+import logging
+import logging.handlers
 import os
+import queue
 import signal
-from typing import Optional
+from typing import Literal, Optional
 
 # Load environment variables from .env
 try:
@@ -13,7 +15,8 @@ except Exception:
     pass
 
 import nats
-from .models import ChatMessage
+from nats.js.api import ConsumerConfig, DeliverPolicy
+from .codec import loads
 try:
     # Prefer package-relative import when executed as a module
     from .history_io import message_history
@@ -21,8 +24,97 @@ except ImportError:
     # Fallback for direct script execution
     from history_io import message_history
 
+try:
+    # Optional: msgspec parses and validates a payload in one pass
+    import msgspec
+except ImportError:
+    msgspec = None  # type: ignore[assignment]
+
+log = logging.getLogger("history")
+
 _nats_connection: Optional[nats.NATS] = None
 
+# Messages pulled from a room's JetStream consumer per round-trip
+FETCH_BATCH = 64
+# Tasks writing fetched batches to Postgres; keep at or below POOL_MAX
+HISTORY_WORKERS = int(os.environ.get("HISTORY_WORKERS", "8"))
+
+# Largest id the messages.server_id INTEGER column can hold
+_MAX_SERVER_ID = 2**31 - 1
+
+# Both decoders mirror ChatMessage without building a model per message;
+# _parse_message then rejects values Postgres would refuse to store.
+_TYPES = ("message", "system")
+_EVENTS = (None, "join", "leave")
+
+
+def _decode_json(data: bytes) -> Optional[dict]:
+    try:
+        # Parses the UTF-8 bytes directly (orjson when installed); decode
+        # and JSON errors are both ValueErrors
+        message = loads(data)
+    except ValueError:
+        return None
+    # type() rather than isinstance so a JSON true is not taken as room 1
+    if not isinstance(message, dict) or type(message.get("serverId")) is not int:
+        return None
+    if (
+        message.get("type") not in _TYPES
+        or message.get("event") not in _EVENTS
+        or not all(
+            message.get(key) is None or isinstance(message[key], str)
+            for key in ("username", "text", "timestamp")
+        )
+    ):
+        return None
+    return message
+
+
+if msgspec is not None:
+
+    class _Payload(msgspec.Struct):
+        serverId: int
+        type: Literal["message", "system"]
+        username: Optional[str] = None
+        text: Optional[str] = None
+        event: Optional[Literal["join", "leave"]] = None
+        timestamp: Optional[str] = None
+
+    _decode_payload = msgspec.json.Decoder(_Payload).decode
+
+    def _decode_msgspec(data: bytes) -> Optional[dict]:
+        try:
+            return msgspec.structs.asdict(_decode_payload(data))
+        except msgspec.DecodeError:
+            return None
+
+    _decode_message = _decode_msgspec
+else:
+    _decode_message = _decode_json
+
+
+def _parse_message(data: bytes) -> Optional[dict]:
+    """Return the validated chat payload as a dict, or None if it can't be stored."""
+    message = _decode_message(data)
+    if message is None or not 0 <= message["serverId"] <= _MAX_SERVER_ID:
+        return None
+    # Postgres text cannot hold NUL characters
+    for key in ("username", "text"):
+        value = message.get(key)
+        if value is not None and "\x00" in value:
+            return None
+    return message
+
+
+def _watch_server_id(subject: str) -> Optional[int]:
+    """Return the room id from a chat.history.watch.{id} subject, if valid."""
+    # Anyone can publish here; check the token instead of catching int()
+    tail = subject.rpartition(".")[2]
+    if not (tail.isascii() and tail.isdecimal()):
+        return None
+    server_id = int(tail)
+    return server_id if server_id <= _MAX_SERVER_ID else None
+
 
 async def get_nats() -> nats.NATS:
     global _nats_connection
@@ -41,11 +133,11 @@ async def run_service() -> None:
     while True:
         try:
             await message_history.init()
-            print("[history] DB pool initialized")
+            log.info("DB pool initialized")
             break
         except Exception as exc:
             attempt += 1
-            print(f"[history] DB init failed (attempt {attempt}): {exc}")
+            log.warning("DB init failed (attempt %d): %s", attempt, exc)
             await asyncio.sleep(min(5 * attempt, 30))
 
     nc = await get_nats()
@@ -56,43 +148,105 @@ async def run_service() -> None:
     except Exception:
         try:
             await js.add_stream(name="CHAT", subjects=["chat.*"])  # basic defaults
-            print("[history] Created CHAT stream")
+            log.info("Created CHAT stream")
         except Exception as exc:
-            print(f"[history] Could not create CHAT stream: {exc}")
-    print("[history] Connected to NATS")
+            log.error("Could not create CHAT stream: %s", exc)
+    log.info("Connected to NATS")
 
-    async def handler(msg: "nats.aio.msg.Msg") -> None:  # type: ignore[name-defined]
-        try:
-            payload = msg.data.decode("utf-8")
-            data = json.loads(payload)
-        except (UnicodeDecodeError, json.JSONDecodeError) as exc:
-            print(f"[history] skip non-json on {msg.subject}: {exc}")
-            return
+    def decode(
+        server_id: int, msg: "nats.aio.msg.Msg"  # type: ignore[name-defined]
+    ) -> Optional[tuple]:
+        data = _parse_message(msg.data)
+        if data is None:
+            log.warning("skip invalid message on %s: %r", msg.subject, msg.data)
+            return None
+        # The room comes from the consumer's subject; the payload must agree
+        if data["serverId"] != server_id:
+            log.warning("skip message for another serverId on %s: %s", msg.subject, data)
+            return None
+        return server_id, data
 
-        server_id = data.get("serverId")
-        if not isinstance(server_id, int):
-            print(f"[history] skip message without numeric serverId on {msg.subject}: {data}")
-            return
+    # Fetched batches waiting for a writer. Bounded so rooms do not fetch far
+    # ahead of Postgres: unacked messages are redelivered after ack_wait.
+    save_queue: asyncio.Queue = asyncio.Queue(maxsize=HISTORY_WORKERS)
 
+    async def consume_room(server_id: int, psub) -> None:
+        backoff = 1
+        while True:
+            try:
+                msgs = await psub.fetch(FETCH_BATCH, timeout=5)
+            except nats.errors.TimeoutError:
+                continue
+            except Exception as exc:
+                # e.g. reconnecting or JetStream unavailable; keep the room
+                # consumer alive and retry, since nothing else restarts it
+                log.warning("fetch failed server=%d, retry in %ds: %s", server_id, backoff, exc)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            backoff = 1
+            # Hand off so the next fetch overlaps this batch's COPY
+            await save_queue.put((server_id, msgs))
+
+    async def save_worker() -> None:
+        while True:
+            server_id, msgs = await save_queue.get()
+            try:
+                items = [decode(server_id, msg) for msg in msgs]
+                batch = [item for item in items if item is not None]
+                # Write the whole fetch with one COPY and ack only once it is
+                # in Postgres; on failure JetStream redelivers after ack_wait.
+                rejected: set[int] = set()
+                try:
+                    await message_history.save_messages_bulk(batch)
+                except Exception as exc:
+                    # One bad row fails the whole COPY; store the rest row by row
+                    log.warning("bulk save failed server=%d, retrying per row: %s", server_id, exc)
+                    try:
+                        stored = await message_history.save_messages_each(batch)
+                    except Exception as exc:
+                        log.error("save failed server=%d: %s", server_id, exc)
+                        continue
+                    rejected = {id(item) for item, ok in zip(batch, stored) if not ok}
+                # Per-batch success line; only emitted with LOG_LEVEL=DEBUG
+                log.debug("saved server=%d count=%d", server_id, len(batch) - len(rejected))
+                for msg, item in zip(msgs, items):
+                    if id(item) in rejected:
+                        # Redelivery would fail the same way; drop it for good
+                        log.warning("drop rejected message on %s: %r", msg.subject, msg.data)
+                        await msg.term()
+                    else:
+                        await msg.ack()
+            finally:
+                save_queue.task_done()
+
+    async def pull_room(server_id: int):
+        room_subject = f"chat.{server_id}"
+        durable = f"history_{server_id}"
+        config = ConsumerConfig(deliver_policy=DeliverPolicy.ALL)
         try:
-            await message_history.save_message(server_id, ChatMessage(**data))
-            # Lightweight success indicator (can be noisy; keep minimal)
-            print(
-                f"[history] saved server={server_id} type={data.get('type')} "
-                f"user={data.get('username')}"
-            )
-        except Exception as exc:
-            print(f"[history] save failed server={server_id}: {exc}")
+            # Rooms used to be consumed by a push consumer; continue from its
+            # ack floor so nothing is stored twice, then retire it.
+            old = await js.consumer_info("CHAT", f"history_room_{server_id}")
+        except nats.js.errors.NotFoundError:
+            pass
+        else:
+            config.deliver_policy = DeliverPolicy.BY_START_SEQUENCE
+            config.opt_start_seq = old.ack_floor.stream_seq + 1
+            await js.delete_consumer("CHAT", old.name)
+        return await js.pull_subscribe(room_subject, durable=durable, stream="CHAT", config=config)
 
     # Dynamic room subscriptions: subscribe when a client joins
-    active_room_subs: dict[int, nats.aio.subscription.Subscription] = {}
+    active_room_subs: dict[int, "nats.js.JetStreamContext.PullSubscription"] = {}
+    room_tasks: list[asyncio.Task] = [
+        asyncio.create_task(save_worker()) for _ in range(HISTORY_WORKERS)
+    ]
 
     async def watch_handler(msg: "nats.aio.msg.Msg") -> None:  # type: ignore[name-defined]
         subject = msg.subject  # chat.history.watch.{server_id}
-        try:
-            server_id = int(subject.rsplit(".", 1)[-1])
-        except Exception:
-            print(f"[history] invalid watch subject: {subject}")
+        server_id = _watch_server_id(subject)
+        if server_id is None:
+            log.warning("invalid watch subject: %s", subject)
             return
         if server_id in active_room_subs:
             return
@@ -103,20 +257,17 @@ async def run_service() -> None:
         except Exception:
             try:
                 await js.add_stream(name="CHAT", subjects=["chat.*"])  # create if missing
-                print("[history] Created CHAT stream before subscribe")
+                log.info("Created CHAT stream before subscribe")
             except Exception:
                 pass
-        sub = await js.subscribe(
-            room_subject,
-            durable=f"history_room_{server_id}",
-            deliver_policy="all",
-            cb=handler,
-        )
-        active_room_subs[server_id] = sub
-        print(f"[history] now watching {room_subject}")
+        # Pull consumer: fetch messages in batches instead of one push per message
+        psub = await pull_room(server_id)
+        active_room_subs[server_id] = psub
+        room_tasks.append(asyncio.create_task(consume_room(server_id, psub)))
+        log.info("now watching %s", room_subject)
 
     await nc.subscribe("chat.history.watch.*", cb=watch_handler)
-    print("[history] Subscribed to chat.history.watch.* (room discovery)")
+    log.info("Subscribed to chat.history.watch.* (room discovery)")
 
     # Wait until cancelled
     stop_event: asyncio.Event = asyncio.Event()
@@ -136,7 +287,9 @@ async def run_service() -> None:
     try:
         await stop_event.wait()
     finally:
-        # Unsubscribe dynamic room subscriptions
+        # Stop writers and room consumers, and unsubscribe room subscriptions
+        for task in room_tasks:
+            task.cancel()
         try:
             for _sid, _sub in list(active_room_subs.items()):
                 try:
@@ -145,6 +298,11 @@ async def run_service() -> None:
                     pass
         except Exception:
             pass
+        # Release DB connections
+        try:
+            await message_history.close()
+        except Exception as exc:
+            log.error("closing history DB failed: %s", exc)
         try:
             if _nats_connection is not None and _nats_connection.is_connected:
                 await _nats_connection.drain()
@@ -153,8 +311,37 @@ async def run_service() -> None:
             pass
 
 
+def _setup_logging() -> logging.handlers.QueueListener:
+    """Route log records through a queue so a thread does the stderr writes.
+
+    The event loop only enqueues records; the blocking I/O happens in the
+    listener thread. Level comes from LOG_LEVEL (default INFO).
+    """
+    records: queue.Queue = queue.Queue(-1)
+    stderr = logging.StreamHandler()
+    stderr.setFormatter(logging.Formatter("%(asctime)s [%(name)s] %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(records, stderr)
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    listener.start()
+    return listener
+
+
 def main() -> None:
-    asyncio.run(run_service())
+    listener = _setup_logging()
+    try:
+        # libuv-backed loop (installed with uvicorn[standard]); cheaper
+        # callbacks and socket I/O than the default selector loop
+        import uvloop
+    except ImportError:
+        run = asyncio.run
+    else:
+        run = uvloop.run
+    try:
+        run(run_service())
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,7 @@
+-- messages.raw_data duplicated the typed columns; history reads rebuild the
+-- JSON from those columns instead. Nothing reads or writes it any more.
+--
+-- Run once, after every web and history pod runs a version that no longer
+-- inserts raw_data:
+--   psql "$DATABASE_URL" -f migrations/001_drop_messages_raw_data.sql
+ALTER TABLE messages DROP COLUMN IF EXISTS raw_data;
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+from fastapi.testclient import TestClient
+
+from chatroom_prototype import app as app_mod
+from chatroom_prototype import codec, history_io
+
+
+class _Msg:
+    def __init__(self, data):
+        self.data = data
+
+
+def test_cold_room_history_does_not_repeat_queued_frames(monkeypatch):
+    stored = codec.encode_msg("system", 1, "bob", event="join")
+    join = codec.encode_msg("system", 1, "alice", event="join")
+
+    async def scenario():
+        room = app_mod.Room(1)
+        queued = deque()
+        room.clients.add(queued.append)
+
+        class History:
+            async def get_recent_rows(self, server_id, limit):
+                # alice's join arrives while the seed query runs and has
+                # already been stored (Postgres formats it differently)
+                await room._on_message(_Msg(join))
+                return [stored, json.dumps(json.loads(join)).encode()]
+
+        monkeypatch.setattr(app_mod, "message_history", History())
+        history = json.loads(await room.history(50, queued))
+        # Later frames still reach the client live
+        await room._on_message(_Msg(b'{"type":"message"}'))
+        return history, list(queued)
+
+    history, queued = asyncio.run(scenario())
+    assert [m["username"] for m in history] == ["bob", "alice"]
+    assert queued == [b'{"type":"message"}']
+
+
+class _Conn:
+    async def fetch(self, query, server_id, limit, server_key):
+        # Stands in for json_build_object, which names the id field after $3
+        message = {
+            "type": "message",
+            server_key: server_id,
+            "username": "alice",
+            "text": "hi",
+            "event": None,
+            "timestamp": "2024-01-01T00:00:00+00:00",
+        }
+        return [{"message": json.dumps(message).encode()}]
+
+
+class _Pool:
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return _Conn()
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+def test_raw_and_validated_messages_match(monkeypatch):
+    history = history_io.MessageHistory("postgres://test")
+    history.pool = _Pool()
+    monkeypatch.setattr(app_mod, "message_history", history)
+
+    async def found(server_id):
+        return {"id": server_id, "name": "Main Room"}
+
+    monkeypatch.setattr(app_mod, "cached_server", found)
+
+    # Without a with-block TestClient skips the lifespan (and its NATS connect)
+    client = TestClient(app_mod.app)
+    raw = client.get("/api/servers/1/messages")
+    validated = client.get("/api/servers/1/messages?validate=1")
+    assert raw.status_code == validated.status_code == 200
+    assert raw.json() == validated.json()
+    assert raw.json()[0]["server_id"] == 1
+
+
+def test_index_revalidates_with_etag(monkeypatch, tmp_path):
+    (tmp_path / "index.html").write_bytes(b"<h1>chat</h1>")
+    monkeypatch.setattr(app_mod, "public_dir", str(tmp_path))
+    monkeypatch.setattr(app_mod, "_index", None)
+
+    client = TestClient(app_mod.app)
+    first = client.get("/")
+    assert first.status_code == 200
+    assert first.content == b"<h1>chat</h1>"
+    etag = first.headers["etag"]
+
+    again = client.get("/", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["etag"] == etag
+
+    stale = client.get("/", headers={"If-None-Match": '"stale"'})
+    assert stale.status_code == 200
+    assert stale.content == b"<h1>chat</h1>"
+
+
+def test_cached_server_shares_lookups_until_ttl(monkeypatch):
+    calls = []
+
+    def lookup(server_id):
+        calls.append(server_id)
+        time.sleep(0.05)
+        return {"id": server_id, "name": "Main Room"} if server_id == 1 else None
+
+    monkeypatch.setattr(app_mod, "_lookup_server", lookup)
+    monkeypatch.setattr(app_mod, "_server_cache", {})
+    monkeypatch.setattr(app_mod, "_server_lookups", {})
+
+    async def scenario():
+        # Concurrent misses share one query; the hit is then served from memory
+        first = await asyncio.gather(*(app_mod.cached_server(1) for _ in range(5)))
+        cached = await app_mod.cached_server(1)
+        # Missing servers are not cached, so a new room shows up at once
+        await app_mod.cached_server(2)
+        await app_mod.cached_server(2)
+        # Past the TTL the row is read again
+        monkeypatch.setattr(app_mod, "SERVER_CACHE_TTL", 0.0)
+        await app_mod.cached_server(1)
+        return first, cached
+
+    first, cached = asyncio.run(scenario())
+    assert first == [{"id": 1, "name": "Main Room"}] * 5
+    assert cached == {"id": 1, "name": "Main Room"}
+    assert calls == [1, 2, 2, 1]
+
+
+def test_room_history_picks_up_rows_stored_after_the_seed(monkeypatch):
+    old = codec.encode_msg("message", 1, "bob", "before")
+    late = codec.encode_msg("message", 1, "bob", "not stored yet")
+    live = codec.encode_msg("message", 1, "alice", "live")
+    table = [old]
+
+    class History:
+        async def get_recent_rows(self, server_id, limit):
+            return list(table)
+
+    monkeypatch.setattr(app_mod, "message_history", History())
+
+    async def scenario():
+        room = app_mod.Room(1)
+        # The history service has not written `late` when the room is seeded
+        first = json.loads(await room.history(50))
+        await room._on_message(_Msg(live))
+        table.extend([late, live])
+        cached = json.loads(await room.history(50))
+        monkeypatch.setattr(app_mod, "HISTORY_CACHE_TTL", 0.0)
+        refreshed = json.loads(await room.history(50))
+        return first, cached, refreshed
+
+    first, cached, refreshed = asyncio.run(scenario())
+    assert [m["text"] for m in first] == ["before"]
+    assert [m["text"] for m in cached] == ["before", "live"]
+    assert [m["text"] for m in refreshed] == ["before", "not stored yet", "live"]
+
+
+def test_stats_report_dropped_frames(monkeypatch):
+    monkeypatch.setattr(app_mod, "dropped_frames", 3)
+    stats = TestClient(app_mod.app).get("/api/stats").json()
+    assert stats["dropped_frames"] == 3
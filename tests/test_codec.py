@@ -0,0 +1,48 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from chatroom_prototype import codec
+from chatroom_prototype.models import ChatMessage
+
+
+def test_encode_message_matches_chat_message_fields():
+    prefix = codec.message_prefix(7, "alice")
+    data = json.loads(codec.encode_message(prefix, "  hello é  "))
+
+    assert data["type"] == "message"
+    assert data["serverId"] == 7
+    assert data["username"] == "alice"
+    assert data["text"] == "hello é"
+    assert data["event"] is None
+
+    msg = ChatMessage(**data)
+    assert msg.serverId == 7
+    assert msg.timestamp.tzinfo is not None
+
+
+def test_encode_message_blank_text_becomes_null():
+    prefix = codec.message_prefix(1, "bob")
+    data = json.loads(codec.encode_message(prefix, "   "))
+    assert data["text"] is None
+
+
+def test_encode_msg_builds_system_frame():
+    data = json.loads(codec.encode_msg("system", 3, "carol", event="leave"))
+    msg = ChatMessage(**data)
+    assert msg.type == "system"
+    assert msg.event == "leave"
+    assert msg.username == "carol"
+    assert msg.text is None
+
+
+def test_loads_many_returns_plain_values():
+    docs = [b'{"a": 1, "b": [1, 2]}', b"[true]", b'"x"']
+    assert codec.loads_many(docs) == [{"a": 1, "b": [1, 2]}, [True], "x"]
+
+
+def test_timestamp_is_current_utc_iso():
+    before = datetime.now(timezone.utc)
+    ts = datetime.fromisoformat(json.loads(codec._timestamp()))
+    after = datetime.now(timezone.utc)
+    assert ts.utcoffset() == timedelta(0)
+    assert before - timedelta(seconds=1) <= ts <= after
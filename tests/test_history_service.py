@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from chatroom_prototype import message_history_service as svc
+
+DECODERS = [svc._decode_json]
+if svc.msgspec is not None:
+    DECODERS.append(svc._decode_msgspec)
+
+
+@pytest.fixture(params=DECODERS, ids=lambda decoder: decoder.__name__)
+def parse(request, monkeypatch):
+    monkeypatch.setattr(svc, "_decode_message", request.param)
+    return svc._parse_message
+
+
+def _payload(**fields):
+    message = {"type": "message", "serverId": 1, "username": "alice", "text": "hi"}
+    message.update(fields)
+    return json.dumps(message).encode()
+
+
+def test_parse_message_accepts_chat_and_system_frames(parse):
+    message = parse(_payload(event=None, timestamp="2024-01-01T00:00:00+00:00"))
+    assert message["serverId"] == 1
+    assert message["username"] == "alice"
+    assert message["text"] == "hi"
+
+    system = parse(_payload(type="system", text=None, event="leave"))
+    assert system["type"] == "system"
+    assert system["event"] == "leave"
+    assert system["text"] is None
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"not json",
+        b"[1, 2]",
+        b'"text"',
+        b'{"type": "message", "text": "no server"}',
+        _payload(serverId=True),
+        _payload(serverId="1"),
+        _payload(type="admin"),
+        _payload(event="kick"),
+        _payload(username=5),
+        _payload(text=["hi"]),
+        _payload(timestamp=123),
+    ],
+)
+def test_parse_message_rejects_malformed_payloads(parse, data):
+    assert parse(data) is None
+
+
+def test_parse_message_rejects_values_postgres_cannot_store(parse):
+    assert parse(_payload(text="a\x00b")) is None
+    assert parse(_payload(username="\x00")) is None
+    assert parse(_payload(serverId=2**31)) is None
+    assert parse(_payload(serverId=-1)) is None
+    assert parse(_payload(serverId=2**31 - 1)) is not None
+
+
+def test_watch_server_id_reads_the_last_token():
+    assert svc._watch_server_id("chat.history.watch.42") == 42
+    assert svc._watch_server_id("chat.history.watch.0") == 0
+
+
+@pytest.mark.parametrize(
+    "subject",
+    [
+        "chat.history.watch.abc",
+        "chat.history.watch.",
+        "chat.history.watch.-1",
+        "chat.history.watch.٣",
+        f"chat.history.watch.{2**31}",
+    ],
+)
+def test_watch_server_id_rejects_invalid_tokens(subject):
+    assert svc._watch_server_id(subject) is None